@@ -4,10 +4,16 @@ from fpdf import FPDF
 import os
 from dotenv import load_dotenv
 import json
+import re
+import hashlib
+from collections import OrderedDict
 from datetime import datetime
+from enum import IntEnum
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import traceback
-import time
+from concurrent.futures import ThreadPoolExecutor
 
 load_dotenv()
 API_KEY = os.getenv("HUGGINGFACE_API_KEY")
@@ -22,150 +28,380 @@ if "story_params" not in st.session_state:
     st.session_state.story_params = {
         "genre": "",
         "tone": "",
-        "word_limit": "",
+        "word_limit": None,
         "character": "",
         "setting": ""
     }
 
-def clean_generated_text(response_text, prompt):
-    if response_text.startswith(prompt):
-        response_text = response_text[len(prompt):].strip()
-    
-    patterns_to_remove = [
-        "In this rewritten version",
-        "The emotional tone of the rewritten story",
-        "While keeping the main plot and setting",
-        "Here's the story with a",
-        "I'd like to rewrite this story with a",
-        "Here's your story with a",
-        "The changes made include:",
-        "Overall, the rewritten story",
-        "**Act I:",
-        "**Act II:",
-        "**Act III:",
-        "**Act IV:",
-        "---",
-        "**Characters:**",
-        "**Setting:**"
-    ]
-    
-    end_positions = []
-    for pattern in patterns_to_remove:
-        pos = response_text.find(pattern)
-        if pos != -1:
-            end_positions.append(pos)
-    
-    if end_positions:
-        response_text = response_text[:min(end_positions)].strip()
-    
-    if "**" in response_text:
-        response_text = response_text.split("**")[0].strip()
-    
-    response_text = response_text.replace("**", "")
-    
-    if "tone:" in response_text.lower():
-        response_text = response_text.split("tone:")[-1].strip()
-    
-    return response_text.strip()
+_STAR = str.maketrans("", "", "*")
 
-def generate_story(api_key, prompt, max_tokens):
+def clean_generated_text(response_text):
+    return response_text.translate(_STAR).strip()
+
+_STORY_PREFIX_RE = re.compile(r'\s*\{\s*"story"\s*:\s*"')
+# The leading group keeps any escaped backslashes so only a real \u escape matches.
+_PARTIAL_UNICODE_ESCAPE_RE = re.compile(r'(?<!\\)((?:\\\\)*)\\u[0-9a-fA-F]{0,3}$')
+_HIGH_SURROGATE_ESCAPE_RE = re.compile(r'(?<!\\)((?:\\\\)*)\\u[dD][89abAB][0-9a-fA-F]{2}$')
+
+def recover_story(response_text):
+    # Decodes the "story" string of a JSON reply that may have been cut off
+    # mid-string by max_tokens or a stop sequence.
+    m = _STORY_PREFIX_RE.match(response_text)
+    if not m:
+        return None
     try:
-        API_URL = "https://api-inference.huggingface.co/models/meta-llama/Llama-3.2-3B-Instruct"
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json",
-            "x-wait-for-model": "true"
-        }
-        data = {
-            "inputs": prompt,
-            "parameters": {
-                "max_new_tokens": max_tokens,
-                "temperature": 0.8,
-                "top_p": 0.9,
-                "do_sample": True
-            }
-        }
+        return json.decoder.scanstring(response_text, m.end(), False)[0]
+    except ValueError:
+        pass
+    body = response_text[m.end():]
+    if (len(body) - len(body.rstrip("\\"))) % 2:
+        body = body[:-1]
+    body = _PARTIAL_UNICODE_ESCAPE_RE.sub(r"\1", body)
+    body = _HIGH_SURROGATE_ESCAPE_RE.sub(r"\1", body)
+    try:
+        return json.decoder.scanstring(body + '"', 0, False)[0]
+    except ValueError:
+        return None
 
-        with st.spinner("Generating story..."):
-            st.info("Sending request to API...")
-            response = requests.post(API_URL, headers=headers, json=data)
-            
-            if response.status_code != 200:
-                st.error(f"API Error: Status Code {response.status_code}")
-                st.error(f"Error Details: {response.text}")
-                return None
+def parse_story(response_text):
+    try:
+        story = json.loads(response_text)["story"]
+    except (ValueError, KeyError, TypeError):
+        story = recover_story(response_text)
+    if not isinstance(story, str):
+        return clean_generated_text(response_text)
+    return story.strip()
 
-            response_data = response.json()
-            st.info("Received response from API")
-            
-            if isinstance(response_data, list) and len(response_data) > 0:
-                generated_text = response_data[0].get("generated_text", "")
-                if not generated_text:
-                    st.error("No text was generated")
-                    return None
-                cleaned_text = clean_generated_text(generated_text, prompt)
-                if not cleaned_text:
-                    st.error("Text was cleaned but resulted in empty content")
-                    return None
-                return cleaned_text
-            else:
-                st.error(f"Unexpected API response format: {response_data}")
-                return None
+def partial_story(response_text):
+    story = recover_story(response_text)
+    if story is not None:
+        return story
+    if response_text.lstrip().startswith("{"):
+        return ""
+    return response_text
+
+MODEL_ID = "meta-llama/Llama-3.2-3B-Instruct"
+API_URL = f"https://api-inference.huggingface.co/models/{MODEL_ID}/v1/chat/completions"
+SYSTEM_PROMPT = (
+    "Write the story directly with no meta-commentary. "
+    'Reply ONLY with JSON: {"story": <text>}'
+)
+STORY_SCHEMA = {
+    "type": "object",
+    "properties": {"story": {"type": "string"}},
+    "required": ["story"]
+}
+STOP_SEQUENCES = ["\n\n\n"]
+
+class WordLimit(IntEnum):
+    REALLY_SHORT = 0
+    SHORT = 1
+    MEDIUM = 2
+    LONG = 3
+    VERY_LONG = 4
+
+WORD_LIMIT_LABELS = (
+    "Really short (150 - 300 words)",
+    "Short (400 - 600 words)",
+    "Medium (700 - 900 words)",
+    "Long (1000 - 1200 words)",
+    "Very long (1300 - 1500 words)"
+)
+WORD_LIMIT_RANGES = (
+    (150, 300),
+    (400, 600),
+    (700, 900),
+    (1000, 1200),
+    (1300, 1500)
+)
+TOKENS_PER_WORD = 1.4
+JSON_OVERHEAD_TOKENS = 32
+
+def token_budget(words):
+    return int(words * TOKENS_PER_WORD) + JSON_OVERHEAD_TOKENS
+
+@st.cache_resource
+def get_http(api_key):
+    session = requests.Session()
+    session.headers.update({
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+        "x-wait-for-model": "true"
+    })
+    retries = Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=frozenset(["POST"]),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retries)
+    session.mount("https://", adapter)
+    return session
+
+STREAM_RENDER_EVERY = 8
+ERROR_BODY_LIMIT = 500
+
+class StoryGenerationError(Exception):
+    pass
+
+def stream_story(api_key, prompt, max_tokens, placeholder=None):
+    data = {
+        "model": MODEL_ID,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        "max_tokens": max_tokens,
+        "temperature": 0.8,
+        "top_p": 0.9,
+        "stop": STOP_SEQUENCES,
+        "response_format": {"type": "json", "value": STORY_SCHEMA},
+        "stream": True
+    }
+
+    response = get_http(api_key).post(API_URL, json=data, timeout=(5, 120), stream=True)
+
+    if response.status_code != 200:
+        raise StoryGenerationError(
+            f"API Error: Status Code {response.status_code}\n\nError Details: {response.text[:ERROR_BODY_LIMIT]}"
+        )
+
+    # SSE responses carry no charset, so requests would otherwise fall back to latin-1.
+    response.encoding = "utf-8"
+    generated_text = ""
+    token_count = 0
+    for line in response.iter_lines(decode_unicode=True):
+        field, _, payload = line.partition(":")
+        if field != "data":
+            continue
+        payload = payload.strip()
+        if payload == "[DONE]":
+            break
+        frame = json.loads(payload)
+        if "error" in frame:
+            raise StoryGenerationError(f"API Error: {frame['error']}")
+        choices = frame.get("choices") or [{}]
+        generated_text += choices[0].get("delta", {}).get("content") or ""
+        token_count += 1
+        if placeholder is not None and token_count % STREAM_RENDER_EVERY == 0:
+            placeholder.markdown(partial_story(generated_text))
+
+    if not generated_text:
+        raise StoryGenerationError("No text was generated")
+    cleaned_text = parse_story(generated_text)
+    if not cleaned_text:
+        raise StoryGenerationError("Text was cleaned but resulted in empty content")
+    return cleaned_text
+
+class StoryCacheMiss(Exception):
+    pass
+
+# Exceptions are never cached, so calling without _story is a pure lookup and
+# calling with it stores the freshly streamed story under (prompt, max_tokens).
+@st.cache_data(persist="disk", max_entries=256, show_spinner=False)
+def _cached_generate(prompt, max_tokens, _story=None):
+    if _story is None:
+        raise StoryCacheMiss()
+    return _story
+
+STORY_CACHE_SIZE = 64
+
+def prompt_key(prompt, max_tokens):
+    return hashlib.blake2b(f"{max_tokens}:{prompt}".encode(), digest_size=16).hexdigest()
+
+def _session_store(prompt, max_tokens, story):
+    story_cache = st.session_state.setdefault("_story_cache", OrderedDict())
+    story_cache[prompt_key(prompt, max_tokens)] = story
+    if len(story_cache) > STORY_CACHE_SIZE:
+        story_cache.popitem(last=False)
+
+def lookup_story(prompt, max_tokens):
+    story_cache = st.session_state.setdefault("_story_cache", OrderedDict())
+    key = prompt_key(prompt, max_tokens)
+    if key in story_cache:
+        story_cache.move_to_end(key)
+        return story_cache[key]
+    try:
+        story = _cached_generate(prompt, max_tokens)
+    except StoryCacheMiss:
+        return None
+    _session_store(prompt, max_tokens, story)
+    return story
+
+def remember_story(prompt, max_tokens, story):
+    # Clearing first makes the fresh story win over any entry already on disk,
+    # so the session and disk caches never disagree for the same prompt.
+    _cached_generate.clear(prompt, max_tokens)
+    _cached_generate(prompt, max_tokens, story)
+    _session_store(prompt, max_tokens, story)
+
+def generate_story(prompt, max_tokens, refresh=False):
+    if not refresh:
+        story = lookup_story(prompt, max_tokens)
+        if story is not None:
+            return story
+
+    status = st.status("Generating story...", expanded=False)
+    placeholder = st.empty()
+    try:
+        status.write("Sending request to API...")
+        story = stream_story(API_KEY, prompt, max_tokens, placeholder)
+        status.update(label="Story generated", state="complete")
+        remember_story(prompt, max_tokens, story)
+        return story
+    except StoryGenerationError as e:
+        status.write(str(e))
+        status.update(label="Story generation failed", state="error", expanded=True)
+        return None
     except requests.exceptions.RequestException as e:
-        st.error(f"API Request Error: {str(e)}")
+        status.write(f"API Request Error: {str(e)}")
+        status.update(label="Story generation failed", state="error", expanded=True)
         return None
     except Exception as e:
-        st.error(f"Error generating story: {str(e)}")
-        st.error(f"Error type: {type(e)}")
+        status.write(f"Error generating story: {str(e)} ({type(e)})")
+        status.update(label="Story generation failed", state="error", expanded=True)
         return None
+    finally:
+        placeholder.empty()
+
+@st.cache_data(show_spinner=False)
+def render_pdf(story, genre, tone):
+    pdf = FPDF()
+    pdf.add_page()
+    
+    pdf.set_left_margin(20)
+    pdf.set_right_margin(20)
+
+    pdf.set_font("Arial", 'B', 16)
+    pdf.cell(0, 10, "Generated Story", ln=True, align='C')
+    pdf.ln(10)
+
+    pdf.set_font("Arial", 'B', 12)
+    pdf.cell(0, 10, f"Genre: {genre}", ln=True)
+    pdf.cell(0, 10, f"Tone: {tone}", ln=True)
+    pdf.ln(5)
+
+    pdf.set_font("Arial", size=12)
+    safe_story = story.encode('latin-1', 'replace').decode('latin-1')
+    body = "\n\n".join(p for p in safe_story.split('\n') if p.strip())
+    pdf.multi_cell(0, 10, body)
+
+    output = pdf.output(dest='S')
+    return output.encode('latin-1') if isinstance(output, str) else bytes(output)
+
+@st.cache_resource
+def get_pdf_executor():
+    return ThreadPoolExecutor(max_workers=1)
+
+def prefetch_pdf(story, genre, tone):
+    # Warms render_pdf's cache in the background; the result is never awaited
+    # here, so Export later hits the cached bytes instead of building them.
+    if st.session_state.get("_pdf_prefetched") == (story, genre, tone):
+        return
+    st.session_state["_pdf_prefetched"] = (story, genre, tone)
+    get_pdf_executor().submit(render_pdf, story, genre, tone)
 
 def export_to_pdf(story, genre, tone):
     try:
-        pdf = FPDF()
-        pdf.add_page()
-        
-        pdf.set_left_margin(20)
-        pdf.set_right_margin(20)
-
-        pdf.set_font("Arial", 'B', 16)
-        pdf.cell(0, 10, "Generated Story", ln=True, align='C')
-        pdf.ln(10)
-
-        pdf.set_font("Arial", 'B', 12)
-        pdf.cell(0, 10, f"Genre: {genre}", ln=True)
-        pdf.cell(0, 10, f"Tone: {tone}", ln=True)
-        pdf.ln(5)
-
-        pdf.set_font("Arial", size=12)
-        paragraphs = story.split('\n')
-        for paragraph in paragraphs:
-            if paragraph.strip():
-                pdf.multi_cell(0, 10, paragraph.encode('latin-1', 'replace').decode('latin-1'))
-                pdf.ln(5)
-
-        file_name = f"story_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
-        pdf.output(file_name)
-        return file_name
+        return render_pdf(story, genre, tone)
     except Exception as e:
         st.error(f"Failed to export story to PDF: {str(e)}")
         return None
 
+_PROMPT_TAIL = (
+    "The story must be between {min_words} and {max_words} words. "
+    "Include a clear beginning, middle, and end with proper character development and plot progression. "
+    "Write the story directly without any explanations or meta-commentary. "
+)
+
 def create_prompt(genre, tone, character, setting, word_limit):
-    word_limits = {
-        "Really short (150 - 300 words)": (150, 300),
-        "Short (400 - 600 words)": (400, 600),
-        "Medium (700 - 900 words)": (700, 900),
-        "Long (1000 - 1200 words)": (1000, 1200),
-        "Very long (1300 - 1500 words)": (1300, 1500)
-    }
-    min_words, max_words = word_limits[word_limit]
+    min_words, max_words = WORD_LIMIT_RANGES[word_limit]
     return (
         f"Write a complete {genre} story with a {tone} tone about {character} in {setting}. "
+        + _PROMPT_TAIL.format(min_words=min_words, max_words=max_words)
+    )
+
+def create_custom_prompt(params, story, instruction, min_words, max_words):
+    return (
+        f"Here is a {params['genre']} story with a {params['tone']} tone about "
+        f"{params['character']} in {params['setting']}:\n\n"
+        f"{story}\n\n"
+        f"Rewrite this story with the following change: {instruction}. "
         f"The story must be between {min_words} and {max_words} words. "
-        "Include a clear beginning, middle, and end with proper character development and plot progression. "
-        "Write the story directly without any explanations or meta-commentary. "
+        "Keep the same genre, tone, character, and setting, but incorporate the requested change. "
+        "Write the story directly without any explanations or meta-commentary."
+    )
+
+def refine_tone_prompt(story, new_tone):
+    return (
+        f"Here is a story:\n\n{story}\n\n"
+        f"Rewrite ONLY the emotional tone of this story to {new_tone}. "
+        "Keep the plot, characters, setting and length identical."
     )
 
+TONE_EDIT_SLACK = 1.2
+
+def story_max_tokens(story):
+    return token_budget(int(len(story.split()) * TONE_EDIT_SLACK))
+
+def apply_refinement(label, key, kind, make_prompt, pending_params, max_tokens=None):
+    if not st.button(label, key=key):
+        return
+    if not st.session_state["current_story"]:
+        st.warning("Generate a story before refining it.")
+        return
+    try:
+        params = st.session_state.story_params
+        min_words, max_words = WORD_LIMIT_RANGES[params['word_limit']]
+        if max_tokens is None:
+            max_tokens = token_budget(max_words)
+        refine_prompt = make_prompt(params, min_words, max_words)
+
+        refined_story = generate_story(refine_prompt, max_tokens)
+
+        if refined_story:
+            st.session_state['temp_refined_story'] = refined_story
+            st.session_state['refined_story_preview'] = refined_story
+            st.session_state['pending_params'] = pending_params
+        else:
+            st.error("Failed to generate refined story. Please try again.")
+
+    except Exception as e:
+        st.error(f"Error during {kind} refinement: {str(e)}")
+        st.error(traceback.format_exc())
+
+def generate_tone_previews(story, max_tokens):
+    prompts = {t: refine_tone_prompt(story, t) for t in TONES}
+    results = {t: lookup_story(prompts[t], max_tokens) for t in TONES}
+    misses = [t for t in TONES if results[t] is None]
+    if not misses:
+        return results
+    get_http(API_KEY)
+
+    def _gen(t):
+        try:
+            return stream_story(API_KEY, prompts[t], max_tokens)
+        except Exception as e:
+            return StoryGenerationError(f"{t}: {str(e)}")
+
+    with ThreadPoolExecutor(max_workers=len(misses)) as executor:
+        fresh = dict(zip(misses, executor.map(_gen, misses)))
+
+    # The preview prompts are the ones "Apply Tone Change" sends, so applying a
+    # previewed tone is served from cache instead of another API call.
+    for t, result in fresh.items():
+        if not isinstance(result, Exception):
+            remember_story(prompts[t], max_tokens, result)
+    results.update(fresh)
+    return results
+
+REFINEMENT_STATE_KEYS = ("temp_refined_story", "refined_story_preview", "pending_params", "tone_previews")
+
+def clear_refinement_state():
+    for key in REFINEMENT_STATE_KEYS:
+        st.session_state.pop(key, None)
+
 def handle_keep_version(refined_story):
     try:
         if not refined_story:
@@ -176,6 +412,7 @@ def handle_keep_version(refined_story):
         st.write("Debug - New story:", refined_story[:100])
         
         st.session_state["current_story"] = refined_story
+        st.session_state.pop("tone_previews", None)
         
         if "story_params" in st.session_state:
             st.session_state.story_params["last_modified"] = datetime.now().isoformat()
@@ -186,31 +423,31 @@ def handle_keep_version(refined_story):
         st.error(f"Error saving new version: {str(e)}")
         return False
 
-word_limits = {
-    "Really short (150 - 300 words)": (150, 300),
-    "Short (400 - 600 words)": (400, 600),
-    "Medium (700 - 900 words)": (700, 900),
-    "Long (1000 - 1200 words)": (1000, 1200),
-    "Very long (1300 - 1500 words)": (1300, 1500)
-}
+TONES = ["Adventurous", "Emotional", "Humorous", "Dark", "Mysterious", "Romantic", "Philosophical"]
 
 st.title("Creative Story Generator")
 st.sidebar.header("Story Parameters")
 
-genre = st.sidebar.selectbox("Genre:", [
-    "Science Fiction", "Fantasy", "Horror", "Mystery", "Romance", "Adventure", 
-    "Historical Fiction", "Thriller", "Drama", "Comedy", "Action"
-])
+with st.sidebar.form("params"):
+    genre = st.selectbox("Genre:", [
+        "Science Fiction", "Fantasy", "Horror", "Mystery", "Romance", "Adventure", 
+        "Historical Fiction", "Thriller", "Drama", "Comedy", "Action"
+    ])
+
+    tone = st.selectbox("Tone:", TONES)
 
-tone = st.sidebar.selectbox("Tone:", [
-    "Adventurous", "Emotional", "Humorous", "Dark", "Mysterious", "Romantic", "Philosophical"
-])
+    character = st.text_input("Character:")
+    setting = st.text_input("Setting:")
+    word_limit = st.selectbox(
+        "Word Limit:",
+        list(WordLimit),
+        format_func=lambda w: WORD_LIMIT_LABELS[w]
+    )
 
-character = st.sidebar.text_input("Character:")
-setting = st.sidebar.text_input("Setting:")
-word_limit = st.sidebar.selectbox("Word Limit:", list(word_limits.keys()))
+    generate_clicked = st.form_submit_button("Generate Story")
+    regenerate_clicked = st.form_submit_button("Regenerate Story")
 
-if st.sidebar.button("Generate Story"):
+if generate_clicked or regenerate_clicked:
     if not character.strip() or not setting.strip():
         st.warning("Please provide both a character and a setting.")
     else:
@@ -222,198 +459,139 @@ if st.sidebar.button("Generate Story"):
             "setting": setting
         }
         prompt = create_prompt(genre, tone, character, setting, word_limit)
-        max_tokens = word_limits[word_limit][1] * 2
-        story = generate_story(API_KEY, prompt, max_tokens)
+        max_tokens = token_budget(WORD_LIMIT_RANGES[word_limit][1])
+        story = generate_story(prompt, max_tokens, refresh=regenerate_clicked)
 
         if story:
             st.session_state["current_story"] = story
+            clear_refinement_state()
             st.success("Story generated successfully!")
 
+# Refinements work from story_area so any manual edits to the current story are kept.
+story_area = st.session_state["current_story"]
 if st.session_state["current_story"]:
     st.markdown("### Generated Story:")
     story_area = st.text_area("Current Story:", st.session_state["current_story"], height=300)
-
-with st.expander("Refine Story"):
-    refine_option = st.radio(
-        "What would you like to change?",
-        ["Change Tone", "Modify Character", "Other Custom Change"]
+    prefetch_pdf(
+        st.session_state["current_story"],
+        st.session_state.story_params['genre'],
+        st.session_state.story_params['tone']
     )
 
-    if refine_option == "Change Tone":
-        new_tone = st.selectbox(
-            "Select new tone:",
-            ["Adventurous", "Emotional", "Humorous", "Dark", "Mysterious", "Romantic", "Philosophical"],
-            key="tone_select"
+@st.fragment
+def refine_panel():
+    with st.expander("Refine Story"):
+        refine_option = st.radio(
+            "What would you like to change?",
+            ["Change Tone", "Modify Character", "Other Custom Change"]
         )
-        
-        if st.button("Apply Tone Change", key="apply_tone"):
-            try:
-                current_word_limit = st.session_state.story_params['word_limit']
-                min_words, max_words = word_limits[current_word_limit]
-                max_tokens = max_words * 2
-                
-                refine_prompt = create_prompt(
-                    st.session_state.story_params['genre'],
-                    new_tone,
-                    st.session_state.story_params['character'],
-                    st.session_state.story_params['setting'],
-                    current_word_limit
-                )
-                
-                with st.spinner("Refining story..."):
-                    refined_story = generate_story(API_KEY, refine_prompt, max_tokens)
-                    
-                    if refined_story:
-                        
-                        st.session_state['temp_refined_story'] = refined_story
-                        
-                       
-                        st.markdown("### Refined Story:")
-                        st.text_area(
-                            "Preview", 
-                            st.session_state['temp_refined_story'],
-                            height=300, 
-                            key=f"refined_story_preview_{int(time.time())}"
+
+        if refine_option == "Change Tone":
+            new_tone = st.selectbox(
+                "Select new tone:",
+                TONES,
+                key="tone_select"
+            )
+
+            apply_refinement(
+                "Apply Tone Change", "apply_tone", "tone",
+                lambda p, min_words, max_words: refine_tone_prompt(story_area, new_tone),
+                {'tone': new_tone},
+                max_tokens=story_max_tokens(story_area)
+            )
+
+            if st.button("Preview All Tones", key="preview_tones"):
+                try:
+                    if not story_area:
+                        raise ValueError("Generate a story before previewing tones.")
+
+                    with st.spinner("Generating all tone variants..."):
+                        tone_previews = generate_tone_previews(
+                            story_area, story_max_tokens(story_area)
                         )
-                        
-                        
-                        col1, col2 = st.columns([1, 4])
-                        with col1:
-                            if st.button("Keep This Version", key=f"keep_version_{int(time.time())}"):
-                                if handle_keep_version(st.session_state['temp_refined_story']):
-                            
-                                    st.session_state.story_params['tone'] = new_tone
-                                    st.success("New version saved!")
-                                    time.sleep(0.5)
-                                    st.rerun()
-                    else:
-                        st.error("Failed to generate refined story. Please try again.")
-                        
-            except Exception as e:
-                st.error(f"Error during tone refinement: {str(e)}")
-                st.error(traceback.format_exc())
+                    st.session_state['tone_previews'] = tone_previews
+                    for t, preview in tone_previews.items():
+                        if not isinstance(preview, Exception):
+                            st.session_state[f"tone_preview_{t}"] = preview
+                except Exception as e:
+                    st.error(f"Error during tone preview: {str(e)}")
+                    st.error(traceback.format_exc())
 
-    
-    elif refine_option == "Modify Character":
-        new_character = st.text_input(
-            "Describe the new main character:",
-            key="char_input"
-        )
-        
-        if st.button("Apply Character Change", key="apply_char"):
-            try:
-                current_word_limit = st.session_state.story_params['word_limit']
-                min_words, max_words = word_limits[current_word_limit]
-                max_tokens = max_words * 2
-                
-                refine_prompt = create_prompt(
+            if st.session_state.get('tone_previews'):
+                tabs = st.tabs(TONES)
+                for tab, preview_tone in zip(tabs, TONES):
+                    with tab:
+                        preview = st.session_state['tone_previews'][preview_tone]
+                        if isinstance(preview, Exception):
+                            st.error(str(preview))
+                            continue
+                        st.text_area("Preview", height=300, key=f"tone_preview_{preview_tone}")
+                        if st.button("Keep This Version", key=f"keep_tone_{preview_tone}"):
+                            if handle_keep_version(preview):
+                                st.session_state.story_params['tone'] = preview_tone
+                                st.session_state['tone_previews'] = None
+                                st.success("New version saved!")
+                                st.rerun()
+
+        elif refine_option == "Modify Character":
+            new_character = st.text_input(
+                "Describe the new main character:",
+                key="char_input"
+            )
+
+            apply_refinement(
+                "Apply Character Change", "apply_char", "character",
+                lambda p, min_words, max_words: create_prompt(
+                    p['genre'], p['tone'], new_character, p['setting'], p['word_limit']
+                ),
+                {'character': new_character}
+            )
+
+        else:
+            custom_instruction = st.text_area(
+                "Describe what changes you'd like to make to the story:",
+                placeholder="Example: Make the ending more surprising, or add more dialogue...",
+                key="custom_input"
+            )
+
+            apply_refinement(
+                "Apply Custom Change", "apply_custom", "custom",
+                lambda p, min_words, max_words: create_custom_prompt(
+                    p, story_area, custom_instruction, min_words, max_words
+                ),
+                {'last_custom_change': custom_instruction}
+            )
+
+        if st.session_state.get('temp_refined_story'):
+            st.markdown("### Refined Story:")
+            st.text_area("Preview", height=300, key="refined_story_preview")
+
+            col1, col2 = st.columns([1, 4])
+            with col1:
+                if st.button("Keep This Version", key="keep_version_btn"):
+                    if handle_keep_version(st.session_state['temp_refined_story']):
+                        st.session_state.story_params.update(st.session_state.get('pending_params', {}))
+                        st.session_state['temp_refined_story'] = None
+                        st.success("New version saved!")
+                        st.rerun()
+
+        if st.session_state["current_story"] and st.button("Export Story to PDF"):
+            with st.spinner("Creating PDF..."):
+                pdf_bytes = export_to_pdf(
+                    st.session_state["current_story"],
                     st.session_state.story_params['genre'],
-                    st.session_state.story_params['tone'],
-                    new_character,
-                    st.session_state.story_params['setting'],
-                    current_word_limit
+                    st.session_state.story_params['tone']
                 )
-                
-                with st.spinner("Refining story..."):
-                    refined_story = generate_story(API_KEY, refine_prompt, max_tokens)
-                    
-                    if refined_story:
-                        st.session_state['temp_refined_story'] = refined_story
-                        
-                        st.markdown("### Refined Story:")
-                        st.text_area(
-                            "Preview", 
-                            st.session_state['temp_refined_story'],
-                            height=300, 
-                            key=f"refined_story_preview_{int(time.time())}"
-                        )
-                        
-                        col1, col2 = st.columns([1, 4])
-                        with col1:
-                            if st.button("Keep This Version", key=f"keep_version_{int(time.time())}"):
-                                if handle_keep_version(st.session_state['temp_refined_story']):
-                                    st.session_state.story_params['character'] = new_character
-                                    st.success("New version saved!")
-                                    time.sleep(0.5)
-                                    st.rerun()
-                    else:
-                        st.error("Failed to generate refined story. Please try again.")
-                        
-            except Exception as e:
-                st.error(f"Error during character refinement: {str(e)}")
-                st.error(traceback.format_exc())
-
-    else:
-        custom_instruction = st.text_area(
-            "Describe what changes you'd like to make to the story:",
-            placeholder="Example: Make the ending more surprising, or add more dialogue...",
-            key="custom_input"
-        )
-        
-        if st.button("Apply Custom Change", key="apply_custom"):
-            try:
-                current_word_limit = st.session_state.story_params['word_limit']
-                min_words, max_words = word_limits[current_word_limit]
-                max_tokens = max_words * 2
-                
-                refine_prompt = (
-                    f"Here is a {st.session_state.story_params['genre']} story with a "
-                    f"{st.session_state.story_params['tone']} tone about "
-                    f"{st.session_state.story_params['character']} in "
-                    f"{st.session_state.story_params['setting']}:\n\n"
-                    f"{story_area}\n\n"
-                    f"Rewrite this story with the following change: {custom_instruction}. "
-                    f"The story must be between {min_words} and {max_words} words. "
-                    "Keep the same genre, tone, character, and setting, but incorporate the requested change. "
-                    "Write the story directly without any explanations or meta-commentary."
+            if pdf_bytes:
+                st.download_button(
+                    label="📥 Download PDF",
+                    data=pdf_bytes,
+                    file_name=f"story_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf",
+                    mime="application/pdf",
+                    key="download_pdf"
                 )
-                
-                with st.spinner("Refining story..."):
-                    refined_story = generate_story(API_KEY, refine_prompt, max_tokens)
-                    
-                    if refined_story:
-                        st.session_state['temp_refined_story'] = refined_story
-                        
-                        st.markdown("### Refined Story:")
-                        st.text_area(
-                            "Preview", 
-                            st.session_state['temp_refined_story'],
-                            height=300, 
-                            key=f"refined_story_preview_{int(time.time())}"
-                        )
-                        
-                        col1, col2 = st.columns([1, 4])
-                        with col1:
-                            if st.button("Keep This Version", key=f"keep_version_{int(time.time())}"):
-                                if handle_keep_version(st.session_state['temp_refined_story']):
-                                    st.session_state.story_params['last_custom_change'] = custom_instruction
-                                    st.success("New version saved!")
-                                    time.sleep(0.5)
-                                    st.rerun()
-                    else:
-                        st.error("Failed to generate refined story. Please try again.")
-                        
-            except Exception as e:
-                st.error(f"Error during custom refinement: {str(e)}")
-                st.error(traceback.format_exc())
-
-
-    if st.button("Export Story to PDF"):
-        with st.spinner("Creating PDF..."):
-            pdf_file = export_to_pdf(st.session_state["current_story"], genre, tone)
-            if pdf_file:
-                try:
-                    with open(pdf_file, "rb") as file:
-                        pdf_bytes = file.read()
-                    st.download_button(
-                        label="📥 Download PDF",
-                        data=pdf_bytes,
-                        file_name=pdf_file,
-                        mime="application/pdf"
-                    )
-                    os.remove(pdf_file)
-                except Exception as e:
-                    st.error(f"Error preparing download: {str(e)}")
+
+refine_panel()
 
 st.sidebar.markdown("---")
 st.sidebar.info("Built by Gianluca Aquilina 348904L")